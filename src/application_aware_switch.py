@@ -15,67 +15,184 @@ assign actions on this flow.
 from pox.core import core
 import pox.openflow.libopenflow_01 as of
 from pox.lib.util import dpid_to_str
+import copy
+import logging
 import socket
+import struct
+import time
+import threading
+import Queue
 import classad
 import htcondor
+from collections import OrderedDict, namedtuple
 from sdn_controller_config import *
 
 log = core.getLogger()
 
+# cached network classad answers expire together with the flow rules
+# installed from them, the cache is bounded to the most recently used IPs
+CLASSAD_TTL = IDLE_TIMEOUT
+CLASSAD_CACHE_SIZE = 4096
+PARSED_CLASSAD_CACHE_SIZE = 256
+
+# how often (in seconds) the access control lists are re-read from htcondor
+POLICY_REFRESH_INTERVAL = 30
+
+# whether to install the return direction rule together with the forward one
+# for flows that no policy applies to, saving the PacketIn of the reply
+INSTALL_REVERSE_FLOWS = str(htcondor.param.get("SDN_INSTALL_REVERSE_FLOWS",
+                                               "True")).lower() in ("true", "1")
+
+# number of threads per switch doing network classad lookups, and how many
+# lookups may wait for them before new packets are dropped
+CLASSAD_WORKERS = int(htcondor.param.get("SDN_WORKERS", 8))
+CLASSAD_QUEUE_SIZE = 1024
+
+# location of the htcondor module, read once instead of per request
+HTCONDOR_MODULE_HOST = htcondor.param["HTCONDOR_MODULE_HOST"]
+HTCONDOR_MODULE_PORT = int(htcondor.param["HTCONDOR_MODULE_PORT"])
+
 # indicate the mac address  of the core switch
 # this should be the mac address of MLXe at HCC
 core_switch_mac = "00-1e-68-04-1c-20"
+# the same mac address as the 48-bit part of a dpid
+CORE_SWITCH_DPID = int(core_switch_mac.replace("-", ""), 16)
 
-local_network_start = []
-local_network_end = []
+# subnet mask, network prefix and broadcast address of the local network
+# as 32-bit integers
+MASK_U32 = 0
+NET_PREFIX = 0
+NET_BROADCAST = 0
 
 # calculated the range of IP address of local network
 def get_network_info():
 
   """ Returns the local network IP address and subnet mask """
+  global MASK_U32, NET_PREFIX, NET_BROADCAST
   f = open('/proc/net/route', 'r')
   lines = f.readlines()
   words = lines[1].split()
-  local_network_ip = words[1]
-  subnet_mask = words[7]
-  local_network_array = []
-  subnet_mask_array = []
-  for i in range(8, 1, -2):
-    octet = local_network_ip[i-2:i]
-    octet = int(octet, 16)
-    local_network_array.append(octet)
-    octet = subnet_mask[i-2:i]
-    octet = int(octet, 16)
-    subnet_mask_array.append(octet)
-  for i in range(4):
-    local_network_start.append(local_network_array[i] & subnet_mask_array[i])
-    local_network_end.append(local_network_array[i] | ((~subnet_mask_array[i]) & 0xFF))
-
-# check whether the destination is within the local network range
-def check_within_local_network(dest):
-
-  for i in range(4):
-    if(dest[i] < local_network_start[i] or dest[i] > local_network_end[i]):
-      return False
-  return True
+  # the kernel prints the addresses, which are in network byte order, as
+  # host order integers in hex
+  (local_network_u32,) = struct.unpack("!I",
+                                       struct.pack("=I", int(words[1], 16)))
+  (MASK_U32,) = struct.unpack("!I", struct.pack("=I", int(words[7], 16)))
+  NET_PREFIX = local_network_u32 & MASK_U32
+  NET_BROADCAST = local_network_u32 | (~MASK_U32 & 0xFFFFFFFF)
+  return local_network_u32, MASK_U32
+
+# check whether the destination is within the local network range,
+# dest_u32 is the IPv4 address as a 32-bit integer, e.g. IPAddr.toUnsigned()
+def check_within_local_network(dest_u32):
+
+  return (dest_u32 & MASK_U32) == NET_PREFIX
+
+# the access control lists a job owner is in
+OwnerPolicy = namedtuple('OwnerPolicy', ['is_blocked', 'is_outside_blocked'])
+
+def _mac_int(ethaddr):
+
+  """ Returns the mac address as 48-bit integer, used as macToPort key """
+  return struct.unpack("!Q", "\x00\x00" + ethaddr.toRaw())[0]
+
+def _reload_policy():
+
+  """ Returns the blocked users, blocked outside users and white list IPs """
+  return (frozenset(htcondor.param["BLOCKED_USERS"].split(',')),
+          frozenset(htcondor.param["BLOCKED_USERS_OUTSIDE"].split(',')),
+          frozenset(htcondor.param["WHITE_LIST_IP"].split(',')))
+
+def _set_policy(policy):
+
+  current = (ApplicationAwareSwitch._blocked_users,
+             ApplicationAwareSwitch._blocked_users_outside,
+             ApplicationAwareSwitch._white_list_ip)
+  if policy != current:
+    (ApplicationAwareSwitch._blocked_users,
+     ApplicationAwareSwitch._blocked_users_outside,
+     ApplicationAwareSwitch._white_list_ip) = policy
+    # the OwnerPolicy cached with the parsed classads must be rebuilt
+    ApplicationAwareSwitch._policy_generation += 1
+
+def refresh_policy():
+
+  """
+  reload htcondor config and re-read the access control lists from it,
+  the next refresh is scheduled first so that a broken config does not
+  stop the refreshes. The previous lists are kept if reading fails.
+  """
+  core.callDelayed(POLICY_REFRESH_INTERVAL, refresh_policy)
+  try:
+    htcondor.reload_config()
+    policy = _reload_policy()
+  except Exception:
+    log.exception("Failed to re-read the access control lists from htcondor"
+                  " config, keep the previous ones.")
+    return
+  _set_policy(policy)
 
 class ApplicationAwareSwitch ():
-    
+
+  # access control lists shared by all switches, see refresh_policy()
+  _blocked_users = frozenset()
+  _blocked_users_outside = frozenset()
+  _white_list_ip = frozenset()
+  # bumped whenever the lists above change
+  _policy_generation = 0
+
   def __init__ (self, connection):
 
     # Switch we will be adding L2 learning switch capabilitites to
     self.connection = connection
+    # check once whether the mac address of the switch which initiates
+    # this connection is the one of the core switch
+    self._is_core = (connection.dpid & 0xFFFFFFFFFFFF) == CORE_SWITCH_DPID
+    if self._is_core:
+      log.debug("Core switch %s connected", dpid_to_str(connection.dpid))
+    # mac address (as 48-bit integer, see _mac_int()) -> port
     self.macToPort = {}
+    # IPv4 address as 32-bit integer -> ((status, classad string), expiry)
+    self._classad_cache = OrderedDict()
+    # classad string -> (parsed classad, OwnerPolicy of its owner, policy
+    # generation the OwnerPolicy was built for), see parse_network_classad()
+    self._parsed_classads = OrderedDict()
+    # IPv4 address as 32-bit integer -> continuations waiting for an
+    # outstanding lookup
+    self._pending_classad = {}
+    # every classad worker thread has its own keep-alive connection to
+    # htcondor module and receive buffer, see _classad_worker()
+    self._rpc = threading.local()
+    # network classad lookups are done by a pool of worker threads so that
+    # PacketIn handling is not blocked on htcondor module
+    self._classad_queue = Queue.Queue()
+    self._classad_threads = []
+    for i in range(CLASSAD_WORKERS):
+      thread = threading.Thread(target=self._classad_worker)
+      thread.daemon = True
+      thread.start()
+      self._classad_threads.append(thread)
+    # skeletons of the flow mods installed by the policies, copied and
+    # completed with match, actions and buffer id for each packet
+    self._tmpl_drop = of.ofp_flow_mod(priority=12, idle_timeout=IDLE_TIMEOUT,
+                                      hard_timeout=HARD_TIMEOUT)
+    self._tmpl_enqueue = of.ofp_flow_mod(priority=12,
+                                         idle_timeout=IDLE_TIMEOUT,
+                                         hard_timeout=HARD_TIMEOUT)
+    # openflow messages waiting to be flushed to the switch in one write
+    self._pending_msgs = []
     connection.addListeners(self)
 
+  def _handle_ConnectionDown (self, event):
+
+    # tell the classad workers to close their connections and quit
+    for thread in self._classad_threads:
+      self._classad_queue.put(None)
+
   def _handle_PacketIn (self, event):
 
     # parsing the input packet
     packet = event.parsed
 
-    # update mac to port mapping
-    self.macToPort[packet.src] = event.port
-
     # drop LLDP packet
     # send command without actions
     if packet.type == packet.LLDP_TYPE:
@@ -83,12 +200,14 @@ class ApplicationAwareSwitch ():
       msg = of.ofp_packet_out()
       msg.buffer_id = event.ofp.buffer_id
       msg.in_port = event.port
-      self.connection.send(msg)
+      self._send_batched(msg)
+      return
 
-    # parse the mac address of switch which initiate this connection
-    connected_switch_mac = dpid_to_str(self.connection.dpid).split('|')[0]
-    log.debug("The detected mac address is %s", connected_switch_mac)
-    if connected_switch_mac == core_switch_mac:
+    # update mac to port mapping, multicast sources are never destinations
+    if not packet.src.isMulticast():
+      self.macToPort[_mac_int(packet.src)] = event.port
+
+    if self._is_core:
       self.handle_packet_for_core_switch(event, packet)
       return
 
@@ -96,6 +215,13 @@ class ApplicationAwareSwitch ():
     ipv4addr = self.get_ip_addr(packet)
     ipv4src = ipv4addr[0]
     ipv4dst = ipv4addr[1]
+    # the 32-bit forms are used for the local network check and as the
+    # classad lookup keys
+    src_u32 = None
+    dst_u32 = None
+    if ipv4src is not None:
+      src_u32 = ipv4src.toUnsigned()
+      dst_u32 = ipv4dst.toUnsigned()
 
     # get the TCP src and dst port
     tcppkt = packet.find('tcp')
@@ -105,130 +231,112 @@ class ApplicationAwareSwitch ():
       tcpsrcp = tcppkt.srcport
       tcpdstp = tcppkt.dstport
 
-    if ipv4src is not None:
+    # htcondor jobs only live in the local network, packets from outside
+    # of it are handled as normal packets without asking htcondor module
+    if (ipv4src is not None and
+        check_within_local_network(src_u32)):
+      # the rest of the handling continues in _after_src_classad once
+      # the network classad answer is available, the destination is
+      # looked up in the same round trip since it is usually needed next
+      self._submit_classad_request(src_u32,
+          lambda received: self._after_src_classad(event, packet, ipv4src,
+                                                   ipv4dst, dst_u32,
+                                                   received),
+          prefetch=dst_u32)
+      return
 
-      received = self.request_network_classad(ipv4src)
+    self.l2_learning(event, packet)
 
-      # check whether network classad is found at htcondor module
-      lines = received.split("\n")
-      if lines[0] == "FOUND":
-                
-        log.info("Network classad for IP %s is found.", str(ipv4src))
-        network_classad = self.str_to_classad(lines)
-                
-        owner = network_classad["Owner"]
-
-        # query htcondor config files to get the list of blocked users
-        # if the owner is in the list, drop the packets from this user.
-
-        blocked_users = htcondor.param["BLOCKED_USERS"]
-        blocked_users = blocked_users.split(',')
-        if owner in blocked_users:
-          # drop
-          log.warning("Packet is from htcondor job whose"
-                      " owner is in the blocked user list. Drop.")
-          # installing openflow rule
-          log.warning("Installing openflow rule to switch to"
-                      "continue dropping similar packets for a while.")
-          msg = of.ofp_flow_mod()
-          msg.priority = 12
-          msg.match.nw_src = ipv4src
-          msg.match.dl_src = packet.src
-          msg.idle_timeout = IDLE_TIMEOUT
-          msg.hard_timeout = HARD_TIMEOUT
-          msg.buffer_id = event.ofp.buffer_id
-          self.connection.send(msg)
-          return
+  def _after_src_classad(self, event, packet, ipv4src, ipv4dst, dst_u32,
+                         received):
+
+    # check whether network classad is found at htcondor module
+    if received[0] == "F":
+
+      log.info("Network classad for IP %s is found.", ipv4src)
+      network_classad, policy = self.parse_network_classad(received[1])
+
+      owner = network_classad["Owner"]
+
+      # check the list of blocked users from htcondor config files
+      # if the owner is in the list, drop the packets from this user.
+      if policy.is_blocked:
+        # drop
+        log.warning("Packet is from htcondor job whose"
+                    " owner is in the blocked user list. Drop.")
+        # installing openflow rule
+        log.warning("Installing openflow rule to switch to"
+                    "continue dropping similar packets for a while.")
+        self._install_drop_flow(event, packet, ipv4src)
+        return
+
+      # job owner is not in blocked user list, the destination decides
+      # what to do next, see _after_dst_classad
+      if ipv4dst is not None:
+        self._submit_classad_request(dst_u32,
+            lambda received: self._after_dst_classad(event, packet, ipv4src,
+                                                     ipv4dst, owner, policy,
+                                                     received))
+        return
+
+    elif received[0] == "N":
+      # proceed as normal packet using l2 switch rules
+      pass
+
+    self.l2_learning(event, packet)
+
+  def _after_dst_classad(self, event, packet, ipv4src, ipv4dst, owner, policy,
+                         received):
+
+    # job owner is not in blocked user list, further check whether the job
+    # owner is in the list that is blocked to communicate with the outside
+    # network.
+    # 1. If it is, further check the destination IP adress of this flow,
+    #    if it is neither to the same job owner nor in the white list,
+    #    then drop the packet, otherwise make the packet through.
+    # 2. If it is not, then this job flow can communicate with anywhere
+    #    except the jobs not from its own job owner, if that is the case,
+    #    just drop the packet; otherwise make it through.
+    blocked_outside = policy.is_outside_blocked
+
+    if received[0] == "F":
+      log.info("Network classad for IP %s is found.", ipv4dst)
+      network_classad = self.str_to_classad(received[1])
+      owner_dst = network_classad["Owner"]
+
+      if owner != owner_dst:
+        # drop
+        # case 1
+        if blocked_outside:
+          log.warning("HTCondor job from user %s is trying to "
+                      "communicate with job from user %s. Drop packet.",
+                      owner, owner_dst)
+        # case 2
         else:
-          # job owner is not in blocked user list, further check whether the job
-          # owner is in the list that is blocked to communicate with the outside
-          # network.
-          # 1. If it is, further check the destination IP adress of this flow, 
-          #    if it is neither to the same job owner nor in the white list, 
-          #    then drop the packet, otherwise make the packet through.
-          # 2. If it is not, then this job flow can communicate with anywhere 
-          #    except the jobs not from its own job owner, if that is the case, 
-          #    just drop the packet; otherwise make it through.
-          blocked_users = htcondor.param["BLOCKED_USERS_OUTSIDE"]
-          blocked_users = blocked_users.split(',')
-          # case 1
-          if owner in blocked_users:
-            if ipv4dst is not None:
-              received = self.request_network_classad(ipv4dst)
-                            
-              lines = received.split("\n")
-              if lines[0] == "FOUND":
-                log.info("Network classad for IP %s is found.", str(ipv4dst))
-                network_classad = self.str_to_classad(lines)
-                owner_dst = network_classad["Owner"]
-
-                if owner != owner_dst:
-                  # drop
-                  log.warning("HTCondor job from user %s is trying to "
-                              "communicate with job from user %s. Drop packet.",
-                              owner, owner_dst)
-                  # installing openflow rule to drop similar packets for a while
-                  msg = of.ofp_flow_mod()
-                  msg.priority = 12
-                  msg.match.nw_src = ipv4src
-                  msg.match.dl_src = packet.src
-                  msg.match.nw_dst = ipv4dst
-                  msg.idle_timeout = IDLE_TIMEOUT
-                  msg.hard_timeout = HARD_TIMEOUT
-                  msg.buffer_id = event.ofp.buffer_id
-                  self.connection.send(msg)
-                  return
-              else:
-                # network classad not found, ipv4dst is not to condor jobs
-                # further check if it is in white list
-                white_list_ip = htcondor.param["WHITE_LIST_IP"]
-                white_list_ip = white_list_ip.split(',')
-                if str(ipv4dst) not in white_list_ip:
-                  # drop
-                  log.warning("HTCondor job from user %s who is blocked to "
-                              "communicate with outside network tries to do"
-                              " that. Drop", owner)
-                  log.warning("Destination IP address is %s", str(ipv4dst))
-                  msg = of.ofp_flow_mod()
-                  msg.priority = 12
-                  msg.match.nw_src = ipv4src
-                  msg.match.dl_src = packet.src
-                  msg.match.nw_dst = ipv4dst
-                  msg.idle_timeout = IDLE_TIMEOUT
-                  msg.hard_timeout = HARD_TIMEOUT
-                  msg.buffer_id = event.ofp.buffer_id
-                  self.connection.send(msg)
-                  return
-          # case 2
-          else:
-            if ipv4dst is not None:
-              received = self.request_network_classad(ipv4dst)
-              lines = received.split("\n")
-              if lines[0] == "FOUND":
-                log.info("Network classad for IP %s is found.", str(ipv4dst))
-                network_classad = self.str_to_classad(lines)
-                owner_dst = network_classad["Owner"]
-
-                if owner != owner_dst:
-                  # drop
-                  log.warning("HTCondor job from user %s tries to communicate"
-                              " with job from user %s. Drop packet.", 
-                              owner, owner_dst)
-                  msg = of.ofp_flow_mod()
-                  msg.priority = 12
-                  msg.match.nw_src = ipv4src
-                  msg.match.dl_src = packet.src
-                  msg.match.nw_dst = ipv4dst
-                  msg.idle_timeout = IDLE_TIMEOUT
-                  msg.hard_timeout = HARD_TIMEOUT
-                  msg.buffer_id = event.ofp.buffer_id
-                  self.connection.send(msg)
-                  return
-
-
-      elif lines[0] == "NOFOUND":
-        # proceed as normal packet using l2 switch rules
-        pass
+          log.warning("HTCondor job from user %s tries to communicate"
+                      " with job from user %s. Drop packet.",
+                      owner, owner_dst)
+        # installing openflow rule to drop similar packets for a while
+        self._install_drop_flow(event, packet, ipv4src, ipv4dst)
+        return
+
+      # both ends are jobs of the same owner, which no policy separates,
+      # so the return traffic can be allowed without asking again
+      self.l2_learning(event, packet, reverse=True)
+      return
+
+    # case 1
+    elif blocked_outside:
+      # network classad not found, ipv4dst is not to condor jobs
+      # further check if it is in white list
+      if str(ipv4dst) not in ApplicationAwareSwitch._white_list_ip:
+        # drop
+        log.warning("HTCondor job from user %s who is blocked to "
+                    "communicate with outside network tries to do"
+                    " that. Drop", owner)
+        log.warning("Destination IP address is %s", ipv4dst)
+        self._install_drop_flow(event, packet, ipv4src, ipv4dst)
+        return
 
     self.l2_learning(event, packet)
 
@@ -243,100 +351,120 @@ class ApplicationAwareSwitch ():
     ipv4addr = self.get_ip_addr(packet)
     ipv4src = ipv4addr[0]
     ipv4dst = ipv4addr[1]
-
+    # the 32-bit forms are used for the local network check and as the
+    # classad lookup keys
+    src_u32 = None
+    dst_u32 = None
     if ipv4src is not None:
-      received = self.request_network_classad(ipv4src)
-            
-      # check whether network classad is found at htcondor module
-      lines = received.split("\n")
-      if lines[0] == "FOUND":
-                
-        log.info("Network classad for IP %s is found.", str(ipv4src))
-        network_classad = self.str_to_classad(lines)
-                
-        owner = network_classad["Owner"]
+      src_u32 = ipv4src.toUnsigned()
+      dst_u32 = ipv4dst.toUnsigned()
+
+    # only traffic from htcondor jobs in the local network is shaped
+    if (ipv4src is not None and
+        check_within_local_network(src_u32)):
+      self._submit_classad_request(src_u32,
+          lambda received: self._after_core_src_classad(event, packet,
+                                                        ipv4src, ipv4dst,
+                                                        dst_u32, received),
+          prefetch=dst_u32)
+      return
+
+    self.l2_learning(event, packet)
+
+  def _after_core_src_classad(self, event, packet, ipv4src, ipv4dst, dst_u32,
+                              received):
+
+    # check whether network classad is found at htcondor module
+    if received[0] == "F":
+
+      log.info("Network classad for IP %s is found.", ipv4src)
+      network_classad = self.str_to_classad(received[1])
+
+      owner = network_classad["Owner"]
+      if log.isEnabledFor(logging.DEBUG):
         tcppkt = packet.find('tcp')
         tcpdstp = 0
         if tcppkt is not None:
           tcpdstp = tcppkt.dstport
         log.debug("The destination tcp port is %s.", tcpdstp)
-        log.info("The source mac is: %s", str(packet.src))
-        log.info("The destination mac is %s", str(packet.dst))
-
-        # Perform WAN bandwidth shaping at core switch via HTCondor group 
-        # accounting. Create queues for different accounting group and attach to
-        # the physical port that connects to WAN, apply different QoS constraint
-        # on different queues, e.g.CMS group has a higher quota, thus QoS is set
-        # to have higher bandwidth allocation
-
-        # First check whether the destination is to other htcondor jobs, if not,
-        # further check whether the destination if in white list (this list 
-        # should include all the lark testbed nodes's IP addresses), if not 
-        # again, then we know this traffic flow is going to outside network; 
-        # check the accouting group (if any) and direct it to the corresponding 
-        # queue and install rules to OpenFlow controller
-        if ipv4dst is not None:
-          log.info("outside IPv4 destination address is %s", str(ipv4dst))
-          received = self.request_network_classad(ipv4dst)
-          lines = received.split("\n")
-          if lines[0] != "FOUND":
-            white_list_ip = htcondor.param["WHITE_LIST_IP"]
-            white_list_ip = white_list_ip.split(',')
-            if str(ipv4dst) not in white_list_ip:
-
-              username = network_classad["Owner"]
-              project = config.check_user_project(username)
-              if project is not None:
-                index = projects_list.index(project)
-                if policy_mode == 'application_oriented':
-                  queue_id = index + htcondor_queues_start_id
-                  #dscp_value = 
-                elif policy_mode == 'project_oriented':
-                  queue_id = index + general_queues_start_id
-                  #dscp_value = 
-              else:
-                if policy_mode == 'application_oriented':
-                  queue_id = htcondor_queues_start_id + htcondor_queues_num - 1
-                  #dscp_value = 
-                elif policy_mode == 'project_oriented':
-                  queue_id = general_queues_start_id + general_queues_num - 1
-                  #dscp_value = 
-
-              # assign flow to corresponding queue that going outside
-              if packet.dst in self.macToPort:
-                port = self.macToPort[packet.dst]
-                log.info("The port number for outgoing traffic is %i", port)
-                log.warning("Direct outgoing traffic for project %s "
-                            "to QoS queue %i", project, queue_id)
-                msg = of.ofp_flow_mod()
-                msg.priority = 12
-                msg.match.dl_type = 0x800
-                msg.match.nw_src = ipv4src
-                msg.match.nw_dst = ipv4dst
-                msg.idle_timeout = IDLE_TIMEOUT
-                msg.hard_timeout = HARD_TIMEOUT
-                msg.actions.append(of.ofp_action_enqueue(port=port, 
-                                                         queue_id=queue_id))
-                msg.buffer_id = event.ofp.buffer_id
-                self.connection.send(msg)
-                return
-
-              # use DSCP bits for QoS instead use dedicated queue
-              #msg = of.ofp_flow_mod()
-              #msg.priority = 12
-              #msg.match.dl_type = 0x800
-              #msg.match.nw_src = ipv4src
-              #msg.match.nw_dst = ipv4dst
-              #msg.idle_timeout = IDLE_TIMEOUT
-              #msg.hard_timeout = HARD_TIMEOUT
-              #msg.actions.append(of.ofp_action_nw_tos(dscp_value))
-              #msg.buffer_id = event.ofp.buffer_id
-              #self.connection.send(msg)
+      log.info("The source mac is: %s", packet.src)
+      log.info("The destination mac is %s", packet.dst)
+
+      # Perform WAN bandwidth shaping at core switch via HTCondor group 
+      # accounting. Create queues for different accounting group and attach to
+      # the physical port that connects to WAN, apply different QoS constraint
+      # on different queues, e.g.CMS group has a higher quota, thus QoS is set
+      # to have higher bandwidth allocation
+
+      # First check whether the destination is to other htcondor jobs, if not,
+      # further check whether the destination if in white list (this list 
+      # should include all the lark testbed nodes's IP addresses), if not 
+      # again, then we know this traffic flow is going to outside network; 
+      # check the accouting group (if any) and direct it to the corresponding 
+      # queue and install rules to OpenFlow controller
+      if ipv4dst is not None:
+        log.info("outside IPv4 destination address is %s", ipv4dst)
+        self._submit_classad_request(dst_u32,
+            lambda received: self._after_core_dst_classad(event, packet,
+                                                          ipv4src, ipv4dst,
+                                                          owner, received))
+        return
+
+    elif received[0] == "N":
+      pass
+
+    self.l2_learning(event, packet)
+
+  def _after_core_dst_classad(self, event, packet, ipv4src, ipv4dst, owner,
+                              received):
+
+    if received[0] != "F":
+      if str(ipv4dst) not in ApplicationAwareSwitch._white_list_ip:
+
+        username = owner
+        project = config.check_user_project(username)
+        if project is not None:
+          index = projects_list.index(project)
+          if policy_mode == 'application_oriented':
+            queue_id = index + htcondor_queues_start_id
+            #dscp_value = 
+          elif policy_mode == 'project_oriented':
+            queue_id = index + general_queues_start_id
+            #dscp_value = 
+        else:
+          if policy_mode == 'application_oriented':
+            queue_id = htcondor_queues_start_id + htcondor_queues_num - 1
+            #dscp_value = 
+          elif policy_mode == 'project_oriented':
+            queue_id = general_queues_start_id + general_queues_num - 1
+            #dscp_value = 
+
+        # assign flow to corresponding queue that going outside
+        port = self.macToPort.get(_mac_int(packet.dst))
+        if port is not None:
+          log.info("The port number for outgoing traffic is %i", port)
+          log.warning("Direct outgoing traffic for project %s "
+                      "to QoS queue %i", project, queue_id)
+          msg = copy.copy(self._tmpl_enqueue)
+          msg.match = of.ofp_match(dl_type=0x800, nw_src=ipv4src,
+                                   nw_dst=ipv4dst)
+          msg.actions = [of.ofp_action_enqueue(port=port, queue_id=queue_id)]
+          msg.buffer_id = event.ofp.buffer_id
+          self._send_batched(msg)
+          return
+
+        # use DSCP bits for QoS instead use dedicated queue
+        #msg = of.ofp_flow_mod()
+        #msg.priority = 12
+        #msg.match.dl_type = 0x800
+        #msg.match.nw_src = ipv4src
+        #msg.match.nw_dst = ipv4dst
+        #msg.idle_timeout = IDLE_TIMEOUT
+        #msg.hard_timeout = HARD_TIMEOUT
+        #msg.actions.append(of.ofp_action_nw_tos(dscp_value))
+        #msg.buffer_id = event.ofp.buffer_id
+        #self._send_batched(msg)
 
-                
-      elif lines[0] == "NOFOUND":
-        pass
-            
     self.l2_learning(event, packet)
                 
   def get_ip_addr(self, packet):
@@ -350,9 +478,16 @@ class ApplicationAwareSwitch ():
     ipv4addr = (ipv4src, ipv4dst);
     return ipv4addr
         
-  def l2_learning(self, event, packet):
+  def l2_learning(self, event, packet, reverse=False):
 
-    if packet.dst not in self.macToPort:
+    """
+    forward the packet as a regular l2 switch. If reverse is set, the
+    rule for the return direction is installed together with the forward
+    rule, callers only set it when no policy applies to the return traffic.
+    """
+
+    port = self.macToPort.get(_mac_int(packet.dst))
+    if port is None:
       # does not know out port
       # flood the packet
       log.debug("Port for %s unkown -- flooding", packet.dst)
@@ -360,21 +495,20 @@ class ApplicationAwareSwitch ():
       msg.actions.append(of.ofp_action_output(port = of.OFPP_FLOOD))
       msg.buffer_id = event.ofp.buffer_id
       msg.in_port = event.port
-      self.connection.send(msg)
+      self._send_batched(msg)
 
     else:
       # check whether the packet's destination is the same port it come from
-      port = self.macToPort[packet.dst]
       if port == event.port:
-        log.warning("Same port for packet from %s -> %s on %s.%s. Drop."
-                    % (packet.src, packet.dst, dpid_to_str(event.dpid), port))
+        log.warning("Same port for packet from %s -> %s on %s.%s. Drop.",
+                    packet.src, packet.dst, dpid_to_str(event.dpid), port)
         # install openflow rule to drop similar packets for a while
         msg = of.ofp_flow_mod()
         msg.match = of.ofp_match.from_packet(packet)
         msg.idle_timeout = IDLE_TIMEOUT
         msg.hard_timeout = HARD_TIMEOUT
         msg.buffer_id = event.ofp.buffer_id
-        self.connection.send(msg)
+        self._send_batched(msg)
       else:
         # we know which port this packet should go
         # just send out a of_packet_out message
@@ -389,28 +523,242 @@ class ApplicationAwareSwitch ():
         msg.hard_timeout = HARD_TIMEOUT
         msg.actions.append(of.ofp_action_output(port = port))
         msg.buffer_id = event.ofp.buffer_id
-        self.connection.send(msg)
+        self._send_batched(msg)
+
+        if reverse and INSTALL_REVERSE_FLOWS:
+          log.debug("installing openflow rule for the reverse direction")
+          msg = of.ofp_flow_mod()
+          msg.priority = 10
+          msg.match.dl_src = packet.dst
+          msg.match.dl_dst = packet.src
+          msg.idle_timeout = IDLE_TIMEOUT
+          msg.hard_timeout = HARD_TIMEOUT
+          msg.actions.append(of.ofp_action_output(port = event.port))
+          self._send_batched(msg)
 
-  def request_network_classad(self, ipv4addr):
+  def _install_drop_flow(self, event, packet, ipv4src, ipv4dst=None):
 
     """
-    connect to htcondor module to ask for the network classad
-    corresponding to the source ipv4 address
+    install openflow rule without actions to drop the packets from
+    ipv4src (to ipv4dst if given) for a while, including this one
     """
-    host = htcondor.param["HTCONDOR_MODULE_HOST"]
-    port = int(htcondor.param["HTCONDOR_MODULE_PORT"])
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            
-    log.debug("Connecting %s.%i for network classad for IP %s", 
-              host, port, str(ipv4addr))
+    msg = copy.copy(self._tmpl_drop)
+    msg.match = of.ofp_match(dl_src=packet.src, nw_src=ipv4src,
+                             nw_dst=ipv4dst)
+    msg.actions = []
+    msg.buffer_id = event.ofp.buffer_id
+    self._send_batched(msg)
+
+  def _send_batched(self, msg):
+
+    """
+    queue an openflow message for the switch, all messages queued during
+    the same POX tick are packed and sent in a single write
+    """
+    if not self._pending_msgs:
+      core.callLater(self._flush_pending_msgs)
+    self._pending_msgs.append(msg)
+
+  def _flush_pending_msgs(self):
+
+    msgs = self._pending_msgs
+    self._pending_msgs = []
+    if msgs:
+      self.connection.send(b''.join(msg.pack() for msg in msgs))
+
+  def _submit_classad_request(self, key, continuation, prefetch=None):
+
+    """
+    look up the network classad answer for the ipv4 address given as the
+    32-bit integer key and call continuation with it. Fresh cached answers
+    are handed over right away, otherwise the lookup is queued to the
+    classad worker threads and continuation is called later from the POX
+    thread. Lookups for an address that is already outstanding share the
+    same request. Not found answers are cached as well. If too many
+    lookups are outstanding the packet is dropped.
+
+    If prefetch (also a 32-bit integer) is given, its answer is fetched in
+    the same request to htcondor module and cached, so that a lookup for
+    it right after does not need another round trip.
+    """
+    received = self._cached_classad(key)
+    if received is not None:
+      continuation(received)
+      return
+
+    pending = self._pending_classad.get(key)
+    if pending is not None:
+      pending.append(continuation)
+      return
+    if self._classad_queue.qsize() >= CLASSAD_QUEUE_SIZE:
+      log.warning("Too many outstanding network classad lookups, drop packet"
+                  " from %s.", socket.inet_ntoa(struct.pack("!I", key)))
+      return
+    self._pending_classad[key] = [continuation]
+    keys = [key]
+    if prefetch is not None:
+      if (prefetch not in self._pending_classad and
+          self._cached_classad(prefetch) is None):
+        self._pending_classad[prefetch] = []
+        keys.append(prefetch)
+    self._classad_queue.put(keys)
+
+  def _cached_classad(self, key):
+
+    """ return the cached answer for the key if it is fresh, else None """
+    entry = self._classad_cache.pop(key, None)
+    if entry is not None and time.time() < entry[1]:
+      # re-insert to mark it as most recently used
+      self._classad_cache[key] = entry
+      return entry[0]
+    return None
+
+  def _complete_classad_requests(self, keys, answers):
+
+    """
+    called on the POX thread with the worker's answers, cache them and
+    resume the PacketIn handling waiting for them
+    """
+    for key, received in zip(keys, answers):
+      continuations = self._pending_classad.pop(key, [])
+      if received is None:
+        # lookup failed, the buffered packets are dropped as before
+        continue
+      self._classad_cache[key] = (received, time.time() + CLASSAD_TTL)
+      if len(self._classad_cache) > CLASSAD_CACHE_SIZE:
+        self._classad_cache.popitem(last=False)
+      for continuation in continuations:
+        continuation(received)
+
+  def _classad_worker(self):
+
+    """
+    worker thread loop, send every queued lookup to htcondor module in
+    one write and hand the answers back to the POX thread
+    """
+    self._rpc.sock = None
+    # receive buffer of the keep-alive connection, grown if needed
+    self._rpc.buf = bytearray(4096)
+    self._rpc.view = memoryview(self._rpc.buf)
     try:
-      sock.connect((host, port))
-      sock.sendall("HTCONDOR" + "\n" + "REQUEST" + "\n" + str(ipv4addr))
-      # receive response from the server
-      received = sock.recv(1024).strip()
+      while True:
+        requests = [self._classad_queue.get()]
+        # drain whatever else is queued so it goes out in the same batch,
+        # but leave the quit markers of the other workers in the queue
+        try:
+          while requests[-1] is not None:
+            requests.append(self._classad_queue.get_nowait())
+        except Queue.Empty:
+          pass
+        if requests[-1] is None:
+          # the switch is gone
+          return
+        keys = [key for request in requests for key in request]
+        try:
+          answers = self.query_network_classads(keys)
+        except socket.error as e:
+          log.error("Network classad request to htcondor module failed: %s",
+                    e)
+          answers = [None] * len(keys)
+        core.callLater(self._complete_classad_requests, keys, answers)
     finally:
-      sock.close()
-    return received
+      self._close_classad_sock()
+
+  def query_network_classads(self, ipv4addrs):
+
+    """
+    ask htcondor module for the network classads corresponding to the
+    ipv4 addresses, given as 32-bit integers, over the keep-alive
+    connection, reconnect and retry once if the connection is broken.
+    Each answer is a (status, classad string) tuple, the string is empty
+    if there is no classad.
+    """
+    for attempt in range(2):
+      try:
+        sock = self._get_classad_sock()
+        sock.sendall("".join("REQUEST" + "\n" +
+                             socket.inet_ntoa(struct.pack("!I", ipv4addr)) +
+                             "\n" for ipv4addr in ipv4addrs))
+        return self._read_classad_responses(sock, len(ipv4addrs))
+      except socket.error:
+        self._close_classad_sock()
+        if attempt:
+          raise
+
+  def _read_classad_responses(self, sock, count):
+
+    """
+    read count responses from the keep-alive connection into the
+    preallocated receive buffer. A response is the status byte and the
+    4-byte length of the classad string, followed by the string. Returns
+    a (status, classad string) tuple per response.
+    """
+    answers = []
+    start = 0
+    end = 0
+    while len(answers) < count:
+      # take every complete response out of the buffer
+      while end - start >= 5:
+        (length,) = struct.unpack_from("!I", self._rpc.buf, start + 1)
+        if end - start < 5 + length:
+          break
+        answers.append((chr(self._rpc.buf[start]),
+                        self._rpc.view[start + 5:start + 5 + length].tobytes()))
+        start += 5 + length
+      if len(answers) == count:
+        break
+
+      # make room for the rest of the pending response
+      needed = 5
+      if end - start >= 5:
+        needed += struct.unpack_from("!I", self._rpc.buf, start + 1)[0]
+      if start + needed > len(self._rpc.buf):
+        self._rpc.buf[:end - start] = self._rpc.buf[start:end]
+        end -= start
+        start = 0
+        if needed > len(self._rpc.buf):
+          # a bytearray can't be resized while the view exists, replace it
+          rpc_buf = bytearray(needed)
+          rpc_buf[:end] = self._rpc.buf[:end]
+          self._rpc.buf = rpc_buf
+          self._rpc.view = memoryview(self._rpc.buf)
+
+      received = sock.recv_into(self._rpc.view[end:])
+      if not received:
+        raise socket.error("connection closed by htcondor module")
+      end += received
+    return answers
+
+  def _get_classad_sock(self):
+
+    """
+    return the keep-alive connection to htcondor module, connect it
+    first if needed
+    """
+    if self._rpc.sock is None:
+      host = HTCONDOR_MODULE_HOST
+      port = HTCONDOR_MODULE_PORT
+      log.debug("Connecting %s.%i for network classad session", host, port)
+      sock = socket.create_connection((host, port))
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      try:
+        sock.sendall("HTCONDOR" + "\n" + "SESSION" + "\n")
+        if self._read_classad_responses(sock, 1)[0][0] != "R":
+          raise socket.error("htcondor module refused classad session")
+      except:
+        sock.close()
+        raise
+      self._rpc.sock = sock
+    return self._rpc.sock
+
+  def _close_classad_sock(self):
+
+    if self._rpc.sock is not None:
+      try:
+        self._rpc.sock.close()
+      except socket.error:
+        pass
+      self._rpc.sock = None
 
   def request_gridftp_info(self, ipv4addr, gridftp_port):
         
@@ -418,8 +766,8 @@ class ApplicationAwareSwitch ():
     connect to htcondor module to ask for the gridftp info
     corresponding to the ipv4addr + port combination
     """
-    host = htcondor.param["HTCONDOR_MODULE_HOST"]
-    port = int(htcondor.param["HTCONDOR_MODULE_PORT"])
+    host = HTCONDOR_MODULE_HOST
+    port = HTCONDOR_MODULE_PORT
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
     log.debug("Connecting %s.%i for gridftp information for %s:%i", 
@@ -433,20 +781,37 @@ class ApplicationAwareSwitch ():
       sock.close()
     return received
     
-  def str_to_classad(self, lines):
+  def str_to_classad(self, classad_text):
 
     """
     parse the network classad string into classad format
-    debug to print out received classad string
     """
-    log.info("Received classad string is:")
-    network_classad = str()
-    for line in lines[1:]:
-      log.info(line)
-      network_classad = network_classad + line
+    return self.parse_network_classad(classad_text)[0]
 
-    network_classad = classad.ClassAd(network_classad)
-    return network_classad
+  def parse_network_classad(self, classad_text):
+
+    """
+    parse the network classad string and return the classad together with
+    the access control lists its owner is in. debug to print out received
+    classad string
+    """
+    log.debug("Received classad string is:\n%s", classad_text)
+    # the same classad is usually returned for many flows of a job,
+    # reuse the parsed classad for recently seen strings
+    entry = self._parsed_classads.pop(classad_text, None)
+    if entry is None:
+      entry = (classad.ClassAd(classad_text), None, None)
+      if len(self._parsed_classads) >= PARSED_CLASSAD_CACHE_SIZE:
+        self._parsed_classads.popitem(last=False)
+    if entry[2] != ApplicationAwareSwitch._policy_generation:
+      # first time seen or the access control lists changed since
+      owner = entry[0]["Owner"]
+      blocked = ApplicationAwareSwitch._blocked_users
+      blocked_outside = ApplicationAwareSwitch._blocked_users_outside
+      policy = OwnerPolicy(owner in blocked, owner in blocked_outside)
+      entry = (entry[0], policy, ApplicationAwareSwitch._policy_generation)
+    self._parsed_classads[classad_text] = entry
+    return entry[0], entry[1]
 
 class application_aware_switch (object):
 
@@ -457,7 +822,7 @@ class application_aware_switch (object):
     core.openflow.addListeners(self)
 
   def _handle_ConnectionUp (self, event):
-    log.debug("Connection %s" % (event.connection,))
+    log.debug("Connection %s", event.connection)
     ApplicationAwareSwitch(event.connection)
 
 def launch ():
@@ -466,4 +831,13 @@ def launch ():
   Starts an application-aware switch
   """
   get_network_info()
+  # classad lookups are only done for sources in this range, see
+  # check_within_local_network()
+  log.info("Local network is %s/%s, only packets from it are checked against"
+           " htcondor jobs",
+           socket.inet_ntoa(struct.pack("!I", NET_PREFIX)),
+           socket.inet_ntoa(struct.pack("!I", MASK_U32)))
+  # the access control lists must be readable at start
+  _set_policy(_reload_policy())
+  core.callDelayed(POLICY_REFRESH_INTERVAL, refresh_policy)
   core.registerNew(application_aware_switch)
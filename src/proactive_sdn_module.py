@@ -33,6 +33,7 @@ rule according to pre-configured network policy to switch.
 
 import re
 import time
+import struct
 import threading
 import SocketServer
 import classad
@@ -113,6 +114,12 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
           group = job_ad.eval("AcctGroup")
           log.info("The accounting group the user belongs to is: %s", group)
         log.info("IP address of internal ethernet device is: %s", ip_src)
+        # application_aware_switch skips the lookup for packets from outside
+        # the local network, so jobs there would not get any policy applied
+        if not check_within_local_network(IPAddr(ip_src).toUnsigned()):
+          log.warning("IP address %s of htcondor job is outside the local"
+                      " network, network policies won't be applied to it.",
+                      ip_src)
         log.info("The owner of submitted job is: %s", job_owner)
 
         network_classad = classad.ClassAd()
@@ -126,15 +133,9 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
         classad_thread_lock.release()
             
       elif (lines[1] == "REQUEST"):
-        network_classad = None
         ip_src = lines[2]
-        classad_thread_lock.acquire()
-        # first check whether classad_dict has the given key
-        if ip_src in classad_dict:
-          network_classad = classad_dict[ip_src]
-        classad_thread_lock.release()
+        network_classad = self.get_network_classad(ip_src)
         if network_classad is not None:
-          log.info("Network classad is %s", network_classad)
           log.info("Found network classad for IP %s, send it back.", ip_src)
           self.request.sendall("FOUND" + network_classad)
         else:
@@ -142,6 +143,12 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
                     " for IP %s, send back no found.", ip_src)
           self.request.sendall("NOFOUND" + "\n")
 
+      elif (lines[1] == "SESSION"):
+        # keep-alive connection opened by application_aware_switch, serve
+        # network classad requests until the switch closes it
+        self.request.sendall(struct.pack("!cI", "R", 0))
+        self.serve_classad_session()
+
       elif (lines[1] == "CLEAN"):
         ip_src = lines[2]
         classad_thread_lock.acquire()
@@ -216,6 +223,55 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
 
     self.request.close()
 
+  def get_network_classad(self, ip_src):
+
+    """
+    return the network classad string stored for the IP address,
+    or None if there is no htcondor job using that address.
+    """
+    network_classad = None
+    classad_thread_lock.acquire()
+    # first check whether classad_dict has the given key
+    if ip_src in classad_dict:
+      network_classad = classad_dict[ip_src]
+    classad_thread_lock.release()
+    if network_classad is not None:
+      log.info("Network classad is %s", network_classad)
+    return network_classad
+
+  def serve_classad_session(self):
+
+    """
+    Serve network classad requests on a keep-alive connection. Each request
+    is "REQUEST\n<ip>\n", each response is the status byte, "F" for found or
+    "N" for not found, and the 4-byte length of the classad string followed
+    by the string itself (if any). The session is acknowledged with an empty
+    "R" response.
+    """
+    rfile = self.request.makefile('rb')
+    try:
+      while True:
+        message_type = rfile.readline()
+        if not message_type:
+          # connection closed by the switch
+          break
+        ip_src = rfile.readline().strip()
+        if message_type.strip() != "REQUEST":
+          log.debug("Unknown message type %s in classad session, close.",
+                    message_type.strip())
+          break
+        network_classad = self.get_network_classad(ip_src)
+        if network_classad is not None:
+          log.info("Found network classad for IP %s, send it back.", ip_src)
+          self.request.sendall(struct.pack("!cI", "F", len(network_classad))
+                               + network_classad)
+        else:
+          log.debug("Can't find network classad" \
+                    " for IP %s, send back no found.", ip_src)
+          self.request.sendall(struct.pack("!cI", "N", 0))
+    finally:
+      rfile.close()
+
   def recv_timeout(self, timeout):
         
     """ 
@@ -275,7 +331,7 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
 
     address = address_port.ip
     # TODO: this function needs to be rewritten
-    #if (!check_within_local_network(address)):
+    #if not check_within_local_network(IPAddr(address).toUnsigned()):
     if(True):
 
       # figure out whether this gridftp transfer is upload or download